@@ -18,12 +18,12 @@ under the License.
 '''
 
 import array
+import errno
 import fcntl
-import glob
 import os
-import re
 import stat
 import struct
+import time
 from pathlib import Path
 
 from configshell_fb import ExecutionError
@@ -35,10 +35,9 @@ from rtslib_fb import (
     PSCSIStorageObject,
     RDMCPStorageObject,
     RTSLibError,
-    RTSRoot,
     UserBackedStorageObject,
 )
-from rtslib_fb.utils import get_block_type
+from rtslib_fb.utils import get_block_type, ignored
 
 from .ui_node import UINode, UIRTSLibNode
 
@@ -61,6 +60,17 @@ alua_state_names = {0: 'Active/optimized',
                      14: 'Offline',
                      15: 'Transitioning'}
 
+# Lowercases the unit letters and drops the 'i' of binary prefixes
+_SIZE_XLATE = str.maketrans('KMGTBI', 'kmgtbi', 'i')
+
+_UNIT_POWERS = {'k': 1, 'm': 2, 'g': 3, 't': 4}
+_KIB = 1024
+_KIB_POWERS = tuple(_KIB ** power for power in range(5))
+
+_HUMAN_UNITS = ('bytes', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB')
+
+_ZERO_FILL_CHUNK = 4 * 1024 * 1024
+
 def human_to_bytes(hsize, kilo=1024):
     '''
     This function converts human-readable amounts of bytes to bytes.
@@ -81,49 +91,62 @@ def human_to_bytes(hsize, kilo=1024):
     @type kilo: int
     @return: An int representing the human-readable string converted to bytes
     '''
-    size = hsize.replace('i', '').lower()
-    if not re.match("^[0-9]+[k|m|g|t]?[b]?$", size):
+    # Plain byte counts need no unit parsing
+    if isinstance(hsize, int):
+        return hsize
+    if hsize.isascii() and hsize.isdigit():
+        return int(hsize)
+
+    size = hsize.translate(_SIZE_XLATE).removesuffix('b')
+    power = _UNIT_POWERS.get(size[-1:], 0)
+    digits = size[:-1] if power else size
+    if not (digits.isascii() and digits.isdigit()):
         raise RTSLibError(f"Cannot interpret size, wrong format: {hsize}")
 
-    size = size.rstrip('ib')
-
-    units = ['k', 'm', 'g', 't']
-    try:
-        power = units.index(size[-1]) + 1
-    except ValueError:
-        power = 0
-        size = int(size)
-    else:
-        size = int(size[:-1])
-
-    return size * (int(kilo) ** power)
+    if kilo == _KIB:
+        return int(digits) * _KIB_POWERS[power]
+    return int(digits) * (int(kilo) ** power)
 
 def bytes_to_human(size):
-    kilo = 1024.0
+    kilo = 1024
 
     # don't use decimal for bytes
     if size < kilo:
         return "%d bytes" % size
-    size /= kilo
 
-    for x in ('KiB', 'MiB', 'GiB', 'TiB', 'PiB'):
-        if size < kilo:
-            return f"{size:3.1f}{x}"
-        size /= kilo
-    return None
+    # Each unit covers 10 more bits of the size
+    power = min((int(size).bit_length() - 1) // 10, len(_HUMAN_UNITS) - 1)
+    return f"{size / (1 << (10 * power)):3.1f}{_HUMAN_UNITS[power]}"
 
 def complete_path(path, stat_fn):
-    filtered = []
-    for entry in glob.glob(path + '*'):
-        st = os.stat(entry)
-        if stat.S_ISDIR(st.st_mode):
-            filtered.append(entry + '/')
-        elif stat_fn(st.st_mode):
-            filtered.append(entry)
+    dirname, basename = os.path.split(path)
+    # Keep the directory part exactly as typed
+    prefix = path[:len(path) - len(basename)]
+
+    files = []
+    dirs = []
+    try:
+        with os.scandir(dirname or '.') as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.startswith(basename):
+                    continue
+                # Like glob, only offer hidden entries when explicitly typed
+                if name.startswith('.') and not basename.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    dirs.append(prefix + name + '/')
+                else:
+                    with ignored(OSError):
+                        if stat_fn(entry.stat().st_mode):
+                            files.append(prefix + name)
+    except OSError:
+        return []
 
     # Put directories at the end
-    return sorted(filtered,
-                  key=lambda s: '~' + s if s.endswith('/') else s)
+    files.sort()
+    dirs.sort()
+    return files + dirs
 
 
 class UIALUATargetPortGroup(UIRTSLibNode):
@@ -228,11 +251,36 @@ class UIBackstores(UINode):
     '''
     The backstores container UI.
     '''
+    # The handlers found over DBus along with when they were looked up.
+    # They hardly ever change, so they are shared across refreshes.
+    _user_backstores_cache = (None, ())
+    user_backstores_cache_secs = 5.0
+
     def __init__(self, parent):
         UINode.__init__(self, 'backstores', parent)
         self.refresh()
 
     def _user_backstores(self):
+        '''
+        Returns the user backstore handlers, only asking DBus again once the
+        cached list is older than user_backstores_cache_secs.
+        '''
+        now = time.monotonic()
+        cached_at, handlers = UIBackstores._user_backstores_cache
+        if cached_at is None or now - cached_at >= self.user_backstores_cache_secs:
+            handlers = tuple(self._query_user_backstores())
+            UIBackstores._user_backstores_cache = (now, handlers)
+        return handlers
+
+    @classmethod
+    def clear_user_backstores_cache(cls):
+        '''
+        Forgets the cached user backstore handlers, so that the next refresh
+        asks DBus again.
+        '''
+        cls._user_backstores_cache = (None, ())
+
+    def _query_user_backstores(self):
         '''
         tcmu-runner (or other daemon providing the same service) exposes a
         DBus ObjectManager-based iface to find handlers it supports.
@@ -248,41 +296,66 @@ class UIBackstores(UINode):
                                                None)
 
             for k, v in mgr_iface.GetManagedObjects().items():
-                tcmu_iface = Gio.DBusProxy.new_sync(bus,
-                                                    Gio.DBusProxyFlags.NONE,
-                                                    None,
-                                                    'org.kernel.TCMUService1',
-                                                    k,
-                                                    'org.kernel.TCMUService1',
-                                                    None)
-                yield (k[k.rfind("/") + 1:], tcmu_iface, v)
+                yield (k[k.rfind("/") + 1:], k, v)
         except Exception:
             return
 
     def refresh(self):
         self._children = set()
-        UIPSCSIBackstore(self)
-        UIRDMCPBackstore(self)
-        UIFileIOBackstore(self)
-        UIBlockBackstore(self)
 
-        for name, iface, prop_dict in self._user_backstores():
-            UIUserBackedBackstore(self, name, iface, prop_dict)
+        # Walk the storage objects once and hand each backstore its own
+        by_plugin = {}
+        for so in self.get_root().rtsroot.storage_objects:
+            by_plugin.setdefault(so.plugin, []).append(so)
+
+        UIPSCSIBackstore(self, by_plugin.get('pscsi', []))
+        UIRDMCPBackstore(self, by_plugin.get('ramdisk', []))
+        UIFileIOBackstore(self, by_plugin.get('fileio', []))
+        UIBlockBackstore(self, by_plugin.get('block', []))
+
+        by_handler = {}
+        for so in by_plugin.get('user', []):
+            config = so.config
+            if config:
+                by_handler.setdefault(config[:config.find("/")], []).append(so)
+
+        for name, object_path, prop_dict in self._user_backstores():
+            UIUserBackedBackstore(self, name, object_path, prop_dict,
+                                  by_handler.get(name, []))
+
+    def ui_command_refresh(self):
+        '''
+        Refreshes and updates the objects tree from the current path.
+        '''
+        # An explicit refresh should pick up newly started handlers
+        self.clear_user_backstores_cache()
+        self.refresh()
 
 class UIBackstore(UINode):
     '''
     A backstore UI.
     Abstract Base Class, do not instantiate.
     '''
-    def __init__(self, plugin, parent):
+    # Whether the kernel accepts emulate_model_alias, None until known
+    _model_alias_supported = None
+
+    def __init__(self, plugin, parent, storage_objects=None):
         UINode.__init__(self, plugin, parent)
-        self.refresh()
+        self.refresh(storage_objects)
 
-    def refresh(self):
+    def refresh(self, storage_objects=None):
+        '''
+        Rebuilds the storage object nodes. If storage_objects is given, it
+        must only hold storage objects of this backstore's plugin.
+        '''
         self._children = set()
-        for so in RTSRoot().storage_objects:
-            if so.plugin == self.name:
-                self.so_cls(so, self)
+        so_cls = self.so_cls
+        if storage_objects is None:
+            plugin = self.name
+            storage_objects = (so for so in self.get_root().rtsroot.storage_objects
+                               if so.plugin == plugin)
+        for so in storage_objects:
+            so_cls(so, self)
 
     def summary(self):
         return (f"Storage Objects: {len(self._children)}", None)
@@ -326,9 +399,8 @@ class UIBackstore(UINode):
         @rtype: list of str
         '''
         if current_param == 'name':
-            names = [child.name for child in self.children]
-            completions = [name for name in names
-                           if name.startswith(text)]
+            completions = [child.name for child in self.children
+                           if child.name.startswith(text)]
         else:
             completions = []
 
@@ -337,21 +409,30 @@ class UIBackstore(UINode):
         return completions
 
     def setup_model_alias(self, storageobject):
-        if self.shell.prefs['export_backstore_name_as_model']:
+        if not self.shell.prefs['export_backstore_name_as_model']:
+            return
+
+        # Once the kernel has refused the attribute, don't try it again
+        if UIBackstore._model_alias_supported is not False:
             try:
                 storageobject.set_attribute("emulate_model_alias", 1)
             except RTSLibError:
-                raise ExecutionError("'export_backstore_name_as_model' is set but"
-                                     " emulate_model_alias\n  not supported by kernel.")
+                UIBackstore._model_alias_supported = False
+            else:
+                UIBackstore._model_alias_supported = True
+                return
+
+        raise ExecutionError("'export_backstore_name_as_model' is set but"
+                             " emulate_model_alias\n  not supported by kernel.")
 
 
 class UIPSCSIBackstore(UIBackstore):
     '''
     PSCSI backstore UI.
     '''
-    def __init__(self, parent):
+    def __init__(self, parent, storage_objects=None):
         self.so_cls = UIPSCSIStorageObject
-        UIBackstore.__init__(self, 'pscsi', parent)
+        UIBackstore.__init__(self, 'pscsi', parent, storage_objects)
 
     def ui_command_create(self, name, dev):
         '''
@@ -378,9 +459,9 @@ class UIRDMCPBackstore(UIBackstore):
     '''
     RDMCP backstore UI.
     '''
-    def __init__(self, parent):
+    def __init__(self, parent, storage_objects=None):
         self.so_cls = UIRamdiskStorageObject
-        UIBackstore.__init__(self, 'ramdisk', parent)
+        UIBackstore.__init__(self, 'ramdisk', parent, storage_objects)
 
     def ui_command_create(self, name, size, nullio=None, wwn=None):
         '''
@@ -398,7 +479,7 @@ class UIRDMCPBackstore(UIBackstore):
         '''
         self.assert_root()
 
-        nullio = self.ui_eval_param(nullio, 'bool', False)
+        nullio = self._eval_bool(nullio, False)
         wwn = self.ui_eval_param(wwn, 'string', None)
 
         so = RDMCPStorageObject(name, human_to_bytes(size), nullio=nullio, wwn=wwn)
@@ -412,35 +493,40 @@ class UIFileIOBackstore(UIBackstore):
     '''
     FileIO backstore UI.
     '''
-    def __init__(self, parent):
+    def __init__(self, parent, storage_objects=None):
         self.so_cls = UIFileioStorageObject
-        UIBackstore.__init__(self, 'fileio', parent)
+        UIBackstore.__init__(self, 'fileio', parent, storage_objects)
 
     def _create_file(self, filename, size, sparse=True):
+        if size <= 0:
+            raise ExecutionError(f"Cannot create {filename} with a size of {size} bytes")
         try:
-            f = open(filename, "w+")  # noqa: SIM115
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
         except OSError:
             raise ExecutionError(f"Could not open {filename}")
         try:
             if sparse:
-                os.ftruncate(f.fileno(), size)
+                os.ftruncate(fd, size)
             else:
                 self.shell.log.info("Writing %d bytes" % size)
                 try:
-                    # Prior to version 3.3, Python does not provide fallocate
-                    os.posix_fallocate(f.fileno(), 0, size)
-                except AttributeError:
-                    while size > 0:
-                        write_size = min(size, 1024)
-                        f.write("\0" * write_size)
-                        size -= write_size
+                    os.posix_fallocate(fd, 0, size)
+                except OSError as e:
+                    if e.errno != errno.EOPNOTSUPP:
+                        raise
+                    # Filesystem cannot preallocate, write the zeroes ourselves
+                    self.shell.log.debug(f"Cannot preallocate {filename}, writing zeroes")
+                    zeroes = memoryview(bytes(_ZERO_FILL_CHUNK))
+                    remaining = size
+                    while remaining > 0:
+                        remaining -= os.write(fd, zeroes[:remaining])
         except OSError:
             Path(filename).unlink()
             raise ExecutionError("Could not expand file to %d bytes" % size)
         except OverflowError:
             raise ExecutionError("The file size is too large (%d bytes)" % size)
         finally:
-            f.close()
+            os.close(fd)
 
     def ui_command_create(self, name, file_or_dev, size=None, write_back=None,
                           sparse=None, wwn=None):
@@ -469,8 +555,8 @@ class UIFileIOBackstore(UIBackstore):
         '''
         self.assert_root()
 
-        sparse = self.ui_eval_param(sparse, 'bool', True)
-        write_back = self.ui_eval_param(write_back, 'bool', True)
+        sparse = self._eval_bool(sparse, True)
+        write_back = self._eval_bool(write_back, True)
         wwn = self.ui_eval_param(wwn, 'string', None)
 
         self.shell.log.debug(f"Using params size={size} write_back={write_back} sparse={sparse}")
@@ -478,10 +564,19 @@ class UIFileIOBackstore(UIBackstore):
         file_or_dev = os.path.expanduser(file_or_dev)
         # can't use is_dev_in_use() on files so just check against other
         # storage object paths
-        file_or_dev_path = Path(file_or_dev)
-        if file_or_dev_path.exists():
-            for so in RTSRoot().storage_objects:
-                if so.udev_path and file_or_dev_path.samefile(so.udev_path):
+        try:
+            file_or_dev_stat = os.stat(file_or_dev)
+        except OSError:
+            file_or_dev_stat = None
+        if file_or_dev_stat is not None:
+            # Stat our path once rather than twice per storage object
+            for so in self.get_root().rtsroot.storage_objects:
+                if not so.udev_path:
+                    continue
+                so_stat = None
+                with ignored(OSError):
+                    so_stat = os.stat(so.udev_path)
+                if so_stat and os.path.samestat(file_or_dev_stat, so_stat):
                     raise ExecutionError(f"storage object for {file_or_dev} already exists: {so.name}")
 
         if get_block_type(file_or_dev) is not None:
@@ -489,12 +584,12 @@ class UIFileIOBackstore(UIBackstore):
                 self.shell.log.info("Block device, size parameter ignored")
                 size = None
             self.shell.log.info("Note: block backstore preferred for best results")
-        elif Path(file_or_dev).is_file():
-            new_size = os.path.getsize(file_or_dev)
+        elif file_or_dev_stat is not None and stat.S_ISREG(file_or_dev_stat.st_mode):
+            new_size = file_or_dev_stat.st_size
             if size:
                 self.shell.log.info(f"{file_or_dev} exists, using its size ({new_size} bytes) instead")
             size = new_size
-        elif Path(file_or_dev).exists():
+        elif file_or_dev_stat is not None:
             raise ExecutionError(f"Path {file_or_dev} exists but is not a file")
         else:
             # create file and extend to given file size
@@ -526,9 +621,9 @@ class UIBlockBackstore(UIBackstore):
     '''
     Block backstore UI.
     '''
-    def __init__(self, parent):
+    def __init__(self, parent, storage_objects=None):
         self.so_cls = UIBlockStorageObject
-        UIBackstore.__init__(self, 'block', parent)
+        UIBackstore.__init__(self, 'block', parent, storage_objects)
 
     def _ui_block_ro_check(self, dev):
         BLKROGET = 0x0000125E  # noqa: N806
@@ -557,7 +652,7 @@ class UIBlockBackstore(UIBackstore):
         self.assert_root()
 
         ro_string = self.ui_eval_param(readonly, 'string', None)
-        readonly = self._ui_block_ro_check(dev) if ro_string is None else self.ui_eval_param(readonly, "bool", False)
+        readonly = self._ui_block_ro_check(dev) if ro_string is None else self._eval_bool(readonly, False)
 
         wwn = self.ui_eval_param(wwn, 'string', None)
 
@@ -583,21 +678,49 @@ class UIUserBackedBackstore(UIBackstore):
     '''
     User backstore UI.
     '''
-    def __init__(self, parent, name, iface, prop_dict):
+    def __init__(self, parent, name, object_path, prop_dict, storage_objects=None):
         self.so_cls = UIUserBackedStorageObject
         self.handler = name
-        self.iface = iface
+        self.object_path = object_path
         self.prop_dict = prop_dict
-        super().__init__("user:" + name, parent)
+        self._iface = None
+        super().__init__("user:" + name, parent, storage_objects)
 
-    def refresh(self):
+    @property
+    def iface(self):
+        '''
+        The handler's DBus proxy, only set up once a command needs it.
+        '''
+        if self._iface is None:
+            try:
+                bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+                self._iface = Gio.DBusProxy.new_sync(bus,
+                                                     Gio.DBusProxyFlags.NONE,
+                                                     None,
+                                                     'org.kernel.TCMUService1',
+                                                     self.object_path,
+                                                     'org.kernel.TCMUService1',
+                                                     None)
+            except Exception as e:
+                raise ExecutionError(f"Could not reach handler {self.handler}: {e}")
+        return self._iface
+
+    def refresh(self, storage_objects=None):
+        '''
+        Rebuilds the storage object nodes. If storage_objects is given, it
+        must only hold storage objects of this backstore's handler.
+        '''
         self._children = set()
-        for so in RTSRoot().storage_objects:
-            if so.plugin == 'user' and so.config:
-                idx = so.config.find("/")
-                handler = so.config[:idx]
-                if handler == self.handler:
-                    self.so_cls(so, self)
+        if storage_objects is None:
+            storage_objects = []
+            for so in self.get_root().rtsroot.storage_objects:
+                if so.plugin != 'user':
+                    continue
+                config = so.config
+                if config and config[:config.find("/")] == self.handler:
+                    storage_objects.append(so)
+        for so in storage_objects:
+            self.so_cls(so, self)
 
     def ui_command_help(self, topic=None):
         super().ui_command_help(topic)
@@ -655,6 +778,9 @@ class UIUserBackedBackstore(UIBackstore):
             raise ExecutionError(f"ChangeMedium failed: {e}")
         else:
             if rc == 0:
+                # Size and config shown in the summary have changed
+                with ignored(ValueError):
+                    self.get_child(name).refresh()
                 self.shell.log.info("Medium Changed.")
             else:
                 raise ExecutionError(f"ChangeMedium failed: {errmsg}")
@@ -705,10 +831,24 @@ class UIStorageObject(UIRTSLibNode):
     def __init__(self, storage_object, parent):
         name = storage_object.name
         UIRTSLibNode.__init__(self, name, storage_object, parent)
+        self._summary_cache = {}
         self.refresh()
 
         UIALUATargetPortGroups(self)
 
+    def refresh(self):
+        self._summary_cache = {}
+        super().refresh()
+
+    def _fixed_property(self, name):
+        '''
+        Returns a storage object property that cannot change once the object
+        exists, only reading it from configfs the first time.
+        '''
+        if name not in self._summary_cache:
+            self._summary_cache[name] = getattr(self.rtsnode, name)
+        return self._summary_cache[name]
+
     def ui_command_version(self):
         '''
         Displays the version of the current backstore's plugin.
@@ -738,7 +878,7 @@ class UIStorageObject(UIRTSLibNode):
 class UIPSCSIStorageObject(UIStorageObject):
     def summary(self):
         so = self.rtsnode
-        return (f"{so.udev_path} {so.status}", True)
+        return (f"{self._fixed_property('udev_path')} {so.status}", True)
 
 
 class UIRamdiskStorageObject(UIStorageObject):
@@ -746,7 +886,7 @@ class UIRamdiskStorageObject(UIStorageObject):
         so = self.rtsnode
 
         nullio_str = ""
-        if so.nullio:
+        if self._fixed_property('nullio'):
             nullio_str = "nullio "
 
         return (f"{nullio_str}({bytes_to_human(so.size)}) {so.status}", True)
@@ -758,7 +898,7 @@ class UIFileioStorageObject(UIStorageObject):
 
         wb_str = "write-back" if so.write_back else "write-thru"
 
-        return (f"{so.udev_path} ({bytes_to_human(so.size)}) {wb_str} {so.status}", True)
+        return (f"{self._fixed_property('udev_path')} ({bytes_to_human(so.size)}) {wb_str} {so.status}", True)
 
 
 class UIBlockStorageObject(UIStorageObject):
@@ -768,20 +908,22 @@ class UIBlockStorageObject(UIStorageObject):
         wb_str = "write-back" if so.write_back else "write-thru"
 
         ro_str = ""
-        if so.readonly:
+        if self._fixed_property('readonly'):
             ro_str = "ro "
 
-        return f"{so.udev_path} ({bytes_to_human(so.size)}) {ro_str}{wb_str} {so.status}", True
+        return (f"{self._fixed_property('udev_path')} ({bytes_to_human(so.size)}) {ro_str}{wb_str} {so.status}",
+                True)
 
 
 class UIUserBackedStorageObject(UIStorageObject):
     def summary(self):
         so = self.rtsnode
+        config = self._fixed_property('config')
 
-        if not so.config:
+        if not config:
             config_str = "(no config)"
         else:
-            idx = so.config.find("/")
-            config_str = so.config[idx + 1:]
+            idx = config.find("/")
+            config_str = config[idx + 1:]
 
         return (f"{config_str} ({bytes_to_human(so.size)}) {so.status}", True)
@@ -60,8 +60,7 @@ class UINode(ConfigNode):
         For commands requiring root privileges, disable command if not the root
         node's as_root attribute is False.
         '''
-        root_node = self.get_root()
-        if hasattr(root_node, 'as_root') and not self.get_root().as_root:
+        if not getattr(self.get_root(), 'as_root', True):
             raise ExecutionError("This privileged command is disabled: you are not root.")
 
     def new_node(self, new_node):
@@ -70,9 +69,10 @@ class UINode(ConfigNode):
         Either returns None if the global is False, or the new_node if the
         global is True. In both cases, set the @last bookmark to last_node.
         '''
-        self.shell.prefs['bookmarks']['last'] = new_node.path
-        self.shell.prefs.save()
-        if self.shell.prefs['auto_cd_after_create']:
+        prefs = self.shell.prefs
+        prefs['bookmarks']['last'] = new_node.path
+        prefs.save()
+        if prefs['auto_cd_after_create']:
             self.shell.log.info(f"Entering new node {new_node.path}")
             # Piggy backs on cd instead of just returning new_node,
             # so we update navigation history.
@@ -107,6 +107,19 @@ class UINode(ConfigNode):
         ConfigNode.ui_setgroup_global(self, parameter, value)
         self.get_root().refresh()
 
+    def _eval_bool(self, value, default):
+        '''
+        Evaluates a bool parameter, only going through ui_eval_param for
+        values other than the plain 'true' and 'false' literals.
+        '''
+        if value is None:
+            return default
+        if value == 'true':
+            return True
+        if value == 'false':
+            return False
+        return self.ui_eval_param(value, 'bool', default)
+
     def ui_type_yesno(self, value=None, enum=False, reverse=False):
         '''
         UI parameter type helper for "Yes" and "No" boolean values.
@@ -143,22 +156,27 @@ class UIRTSLibNode(UINode):
             return
 
         # If the rtsnode has parameters, use them
-        parameters = self.rtsnode.list_parameters()
-        parameters_ro = self.rtsnode.list_parameters(writable=False)
-        for parameter in parameters:
-            writable = parameter not in parameters_ro
-            param_type, desc = getattr(self.__class__, 'ui_desc_parameters', {}).get(parameter, ('string', ''))
-            self.define_config_group_param(
-                'parameter', parameter, param_type, desc, writable)
+        self._define_rtslib_group(
+            'parameter', self.rtsnode.list_parameters(),
+            self.rtsnode.list_parameters(writable=False),
+            getattr(self.__class__, 'ui_desc_parameters', {}))
 
         # If the rtsnode has attributes, enable them
-        attributes = self.rtsnode.list_attributes()
-        attributes_ro = self.rtsnode.list_attributes(writable=False)
-        for attribute in attributes:
-            writable = attribute not in attributes_ro
-            param_type, desc = getattr(self.__class__, 'ui_desc_attributes', {}).get(attribute, ('string', ''))
-            self.define_config_group_param(
-                'attribute', attribute, param_type, desc, writable)
+        self._define_rtslib_group(
+            'attribute', self.rtsnode.list_attributes(),
+            self.rtsnode.list_attributes(writable=False),
+            getattr(self.__class__, 'ui_desc_attributes', {}))
+
+    def _define_rtslib_group(self, group, names, names_ro, descs):
+        '''
+        Defines a config group parameter for each of the rtsnode's parameters
+        or attributes in names, described by the matching descs entry.
+        '''
+        names_ro = frozenset(names_ro)
+        define = self.define_config_group_param
+        for name in names:
+            param_type, desc = descs.get(name, ('string', ''))
+            define(group, name, param_type, desc, name not in names_ro)
 
     def ui_getgroup_attribute(self, attribute):
         '''
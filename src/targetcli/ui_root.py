@@ -18,12 +18,11 @@ under the License.
 '''
 
 import gzip
+import hashlib
 import os
 import re
-import shutil
 import stat
 from datetime import datetime
-from glob import glob
 from pathlib import Path, PurePosixPath
 
 from configshell_fb import ExecutionError
@@ -39,6 +38,10 @@ from .ui_target import UIFabricModule
 default_target_dir = "/etc/target"
 default_save_file = os.path.join(default_target_dir, "saveconfig.json")
 universal_prefs_file = os.path.join(default_target_dir, "targetcli.conf")
+# Records the latest backup's name and the digest of the config it holds
+backup_digest_file = ".saveconfig-last.digest"
+
+_MAX_BACKUP_RE = re.compile(r'^\s*max_backup_files\s*=\s*(\d+)')
 
 class UIRoot(UINode):
     '''
@@ -48,6 +51,9 @@ class UIRoot(UINode):
         UINode.__init__(self, '/', shell=shell)
         self.as_root = as_root
         self.rtsroot = RTSRoot()
+        self._prefs_cache = (None, None)
+        # Older rtslib versions have no caches to invalidate
+        self._invalidate_caches = getattr(self.rtsroot, 'invalidate_caches', None)
 
     def refresh(self):
         '''
@@ -56,8 +62,8 @@ class UIRoot(UINode):
         self._children = set()
 
         # Invalidate any rtslib caches
-        if 'invalidate_caches' in dir(RTSRoot):
-            self.rtsroot.invalidate_caches()
+        if self._invalidate_caches is not None:
+            self._invalidate_caches()
 
         UIBackstores(self)
 
@@ -66,30 +72,87 @@ class UIRoot(UINode):
             if fm.wwns is None or any(fm.wwns):
                 UIFabricModule(fm, self)
 
+    def ui_command_refresh(self):
+        '''
+        Refreshes and updates the objects tree from the current path.
+        '''
+        # An explicit refresh should pick up newly started user backstore
+        # handlers, as it does in /backstores
+        UIBackstores.clear_user_backstores_cache()
+        self.refresh()
+
     def _compare_files(self, backupfile, savefile):
         '''
         Compare backfile and saveconfig file
         '''
-        backupfilepath = Path(backupfile)
-        if PurePosixPath(backupfile).suffix == '.gz':
-            try:
-                with gzip.open(backupfilepath, 'rb') as fbkp:
-                    fdata_bkp = fbkp.read()
-            except OSError as e:
-                self.shell.log.warning(f"Could not gzip open backupfile {backupfile}: {e.strerror}")
-
-        else:
-            try:
-                fdata_bkp = backupfilepath.read_bytes()
-            except OSError as e:
-                self.shell.log.warning(f"Could not open backupfile {backupfile}: {e.strerror}")
+        is_gzip = PurePosixPath(backupfile).suffix == '.gz'
 
+        # Compare in growing chunks, so that a difference near the start is
+        # found quickly while long identical files are still read in big blocks
+        chunk_size = 4 * 1024
+        max_chunk_size = 64 * 1024
         try:
-            fdata = Path(savefile).read_bytes()
-        except OSError as e:
-            self.shell.log.warning(f"Could not open saveconfig file {savefile}: {e.strerror}")
+            with (gzip.open(backupfile, 'rb') if is_gzip else open(backupfile, 'rb')) as fbkp, \
+                 open(savefile, 'rb') as fsave:
+                while True:
+                    data_bkp = fbkp.read(chunk_size)
+                    if data_bkp != fsave.read(chunk_size):
+                        return False
+                    if not data_bkp:
+                        return True
+                    chunk_size = min(chunk_size * 2, max_chunk_size)
+        except (OSError, EOFError) as e:
+            self.shell.log.warning(f"Could not compare backupfile {backupfile} with {savefile}: {e}")
+            return False
+
+    def _file_digest(self, filename):
+        '''
+        Return the hex digest of a file's contents, or None if unreadable
+        '''
+        digest = hashlib.blake2b(digest_size=16)
+        try:
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        return digest.hexdigest()
+
+    def _sizes_differ(self, backupfile, savefile):
+        '''
+        Check whether backupfile and savefile hold data of different sizes,
+        without reading either file. Returns False if unsure.
+        '''
+        # A gzip trailer ends with the uncompressed size modulo 2**32
+        with ignored(OSError):
+            save_size = os.stat(savefile).st_size
+            if PurePosixPath(backupfile).suffix == '.gz':
+                with open(backupfile, 'rb') as fbkp:
+                    fbkp.seek(-4, os.SEEK_END)
+                    backup_size = int.from_bytes(fbkp.read(4), 'little')
+                save_size &= 0xFFFFFFFF
+            else:
+                backup_size = os.stat(backupfile).st_size
+            return backup_size != save_size
+        return False
+
+    def _same_as_backup(self, backupfile, savefile):
+        '''
+        Check whether savefile matches backupfile, using the digest recorded
+        when that backup was taken if there is one
+        '''
+        # Differing sizes mean differing contents, so this settles the
+        # common case of a changed config before any file is read
+        if self._sizes_differ(backupfile, savefile):
+            return False
+
+        digest_path = Path(os.path.dirname(backupfile), backup_digest_file)
+        with ignored(OSError, ValueError):
+            name, digest = digest_path.read_text().split()
+            if name == os.path.basename(backupfile):
+                return digest == self._file_digest(savefile)
 
-        return fdata_bkp == fdata
+        return self._compare_files(backupfile, savefile)
 
     def _create_dir(self, dirname):
         '''
@@ -110,6 +173,33 @@ class UIRoot(UINode):
         elif dirname == default_target_dir and (os.stat(dirname).st_mode & 0o777) != mode:
             os.chmod(dirname, mode)
 
+    def _get_universal_max_backups(self):
+        '''
+        Return max_backup_files from the universal prefs file, or None if it
+        cannot be read or does not set it. The parsed value is cached until
+        the file changes.
+        '''
+        try:
+            st = os.stat(universal_prefs_file)
+        except OSError:
+            return None
+
+        key = (universal_prefs_file, st.st_mtime_ns, st.st_size)
+        cached_key, cached_value = self._prefs_cache
+        if cached_key == key:
+            return cached_value
+
+        value = None
+        with ignored(OSError, UnicodeDecodeError), open(universal_prefs_file) as prefs:
+            for line in prefs:
+                m = _MAX_BACKUP_RE.match(line)
+                if m:
+                    value = int(m.group(1))
+                    break
+
+        self._prefs_cache = (key, value)
+        return value
+
     def _save_backups(self, savefile):
         '''
         Take backup of config-file if needed.
@@ -118,10 +208,9 @@ class UIRoot(UINode):
         if savefile != default_save_file:
             return
 
-        backup_dir = os.path.dirname(savefile) + "/backup/"
-        backup_name = "saveconfig-" + \
-                      datetime.now().strftime("%Y%m%d-%H:%M:%S") + "-json.gz"
-        backupfile = backup_dir + backup_name
+        backup_dir = os.path.join(os.path.dirname(savefile), "backup")
+        backup_name = f"saveconfig-{datetime.now():%Y%m%d-%H%M%S}-json.gz"
+        backupfile = os.path.join(backup_dir, backup_name)
         backup_error = None
 
         self._create_dir(backup_dir)
@@ -130,20 +219,34 @@ class UIRoot(UINode):
         if not Path(savefile).exists():
             return
 
-        backed_files_list = sorted(glob(os.path.dirname(savefile) + \
-                                   "/backup/saveconfig-*json*"))
+        # List the existing backups in a single directory scan. Older
+        # backups have colons in their timestamp, ignore them when ordering.
+        with os.scandir(backup_dir) as entries:
+            backed_files_list = sorted((entry.path for entry in entries
+                                        if entry.name.startswith("saveconfig-")
+                                        and "json" in entry.name[len("saveconfig-"):]),
+                                       key=lambda f: f.replace(":", ""))
 
         # Save backup if backup dir is empty, or savefile is differnt from recent backup copy
-        if not backed_files_list or not self._compare_files(backed_files_list[-1], savefile):
+        if not backed_files_list or \
+           not self._same_as_backup(backed_files_list[-1], savefile):
             mode = stat.S_IRUSR | stat.S_IWUSR  # 0o600
             umask = 0o777 ^ mode  # Prevents always downgrading umask to 0
             umask_original = os.umask(umask)
+            # Hash the config while copying it, for the next save's check
+            digest = hashlib.blake2b(digest_size=16)
             try:
                 with open(savefile, 'rb') as f_in, gzip.open(backupfile, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+                    for chunk in iter(lambda: f_in.read(64 * 1024), b''):
+                        digest.update(chunk)
+                        f_out.write(chunk)
                     f_out.flush()
             except OSError as ioe:
                 backup_error = ioe.strerror or "Unknown error"
+            else:
+                with ignored(OSError):
+                    Path(backup_dir, backup_digest_file).write_text(
+                        f"{backup_name} {digest.hexdigest()}\n")
             finally:
                 os.umask(umask_original)
 
@@ -151,18 +254,17 @@ class UIRoot(UINode):
                 # remove excess backups
                 max_backup_files = int(self.shell.prefs['max_backup_files'])
 
-                try:
-                    prefs = Path(universal_prefs_file).read_text()
-                    backups = [line for line in prefs.splitlines() if re.match(
-                        r'^max_backup_files\s*=', line)]
-                    if max_backup_files < int(backups[0].split('=')[1].strip()):
-                        max_backup_files = int(backups[0].split('=')[1].strip())
-                except:
+                universal_max_backups = self._get_universal_max_backups()
+                if universal_max_backups is None:
                     self.shell.log.debug(f"No universal prefs file '{universal_prefs_file}'.")
+                elif max_backup_files < universal_max_backups:
+                    max_backup_files = universal_max_backups
 
-                files_to_unlink = list(reversed(backed_files_list))[max_backup_files - 1:]
+                # The new backup is not in the list, so keep one fewer of the old ones
+                keep = max_backup_files - 1
+                files_to_unlink = backed_files_list[:-keep] if keep > 0 else backed_files_list
                 for f in files_to_unlink:
-                    with ignored(IOError):
+                    with ignored(OSError):
                         Path(f).unlink()
 
                 self.shell.log.info("Last %d configs saved in %s."
@@ -197,16 +299,22 @@ class UIRoot(UINode):
         '''
         self.assert_root()
 
-        savefile = os.path.expanduser(savefile)
+        if not savefile:
+            savefile = default_save_file
 
-        if not os.path.isfile(savefile):
-            self.shell.log.info(f"Restore file {savefile} not found")
-            return
+        savefile = os.path.expanduser(savefile)
 
         target = self.ui_eval_param(target, 'string', None)
         storage_object = self.ui_eval_param(storage_object, 'string', None)
-        errors = self.rtsroot.restore_from_file(savefile, clear_existing,
-                                                target, storage_object)
+        try:
+            errors = self.rtsroot.restore_from_file(savefile, clear_existing,
+                                                    target, storage_object)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError) as exc:
+            # Only a missing restore file itself is reported as not found
+            if exc.filename != savefile:
+                raise
+            self.shell.log.info(f"Restore file {savefile} not found")
+            return
 
         self.refresh()
 
@@ -235,7 +343,7 @@ class UIRoot(UINode):
         '''
         self.assert_root()
 
-        confirm = self.ui_eval_param(confirm, 'bool', False)
+        confirm = self._eval_bool(confirm, False)
 
         self.rtsroot.clear_existing(confirm=confirm)
 
@@ -280,19 +388,26 @@ class UIRoot(UINode):
             raise ExecutionError(f"action must be one of: {', '.join(action_list)}")
         if sid is not None:
             try:
-                int(sid)
+                sid = int(sid)
             except ValueError:
                 raise ExecutionError(f"sid must be a number, '{sid}' given")
 
+        console = self.shell.con
+
         def indent_print(text, steps):
-            console = self.shell.con
             console.display(console.indent(text, indent_step * steps),
                             no_lf=True)
 
         def print_session(session):
+            # Build the whole session block and write it out at once
+            lines = []
+
+            def add_line(text, steps):
+                lines.append(console.indent(text, indent_step * steps))
+
             acl = session['parent_nodeacl']
-            indent_print("alias: %(alias)s\tsid: %(id)i type: %(type)s session-state: %(state)s" % session,
-                         base_steps)
+            add_line(f"alias: {session['alias']}\tsid: {session['id']} type: {session['type']} "
+                     f"session-state: {session['state']}", base_steps)
 
             if action == 'detail':
                 if self.as_root:
@@ -300,23 +415,27 @@ class UIRoot(UINode):
                 else:
                     auth = ""
 
-                indent_print(f"name: {acl.node_wwn}{auth}",
-                                 base_steps + 1)
+                add_line(f"name: {acl.node_wwn}{auth}",
+                         base_steps + 1)
 
                 for mlun in acl.mapped_luns:
                     plugin = mlun.tpg_lun.storage_object.plugin
                     name = mlun.tpg_lun.storage_object.name
                     mode = "r" if mlun.write_protect else "rw"
-                    indent_print("mapped-lun: %d backstore: %s/%s mode: %s" %
-                                 (mlun.mapped_lun, plugin, name, mode),
-                                 base_steps + 1)
+                    add_line(f"mapped-lun: {mlun.mapped_lun} backstore: {plugin}/{name} mode: {mode}",
+                             base_steps + 1)
 
                 for connection in session['connections']:
-                    indent_print("address: %(address)s (%(transport)s)  cid: %(cid)i connection-state: %(cstate)s"
-                                 % connection, base_steps + 1)
+                    add_line(f"address: {connection['address']} ({connection['transport']})  "
+                             f"cid: {connection['cid']} connection-state: {connection['cstate']}",
+                             base_steps + 1)
 
-        if sid:
-            printed_sessions = [x for x in self.rtsroot.sessions if x['id'] == int(sid)]
+            console.display("".join(lines), no_lf=True)
+
+        if sid is not None:
+            # Session ids are unique, so stop scanning at the first match
+            session = next((x for x in self.rtsroot.sessions if x['id'] == sid), None)
+            printed_sessions = [session] if session is not None else []
         else:
             printed_sessions = list(self.rtsroot.sessions)
 
@@ -326,4 +445,4 @@ class UIRoot(UINode):
         elif sid is None:
             indent_print("(no open sessions)", base_steps)
         else:
-            raise ExecutionError("no session found with sid %i" % int(sid))
+            raise ExecutionError("no session found with sid %i" % sid)
@@ -89,7 +89,7 @@ class UIFabricModule(UIRTSLibNode):
 
         params_func = getattr(self.rtsnode, f"list_{group}s")
         params = params_func()
-        params_ro = params_func(writable=False)
+        params_ro = frozenset(params_func(writable=False))
 
         ret_list = []
         for param in params: